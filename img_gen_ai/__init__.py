@@ -1,2 +1,11 @@
 """AI Image Generator package initialization."""
-from .app import app
+
+
+def __getattr__(name):
+    # Load the Flask app on first access: it needs GCP credentials at import time,
+    # while modules such as img_gen_ai.callbacks can be imported without them.
+    if name == "app":
+        from .app import app
+        globals()["app"] = app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,29 +6,34 @@ A Flask application that provides endpoints to generate and edit images using Go
 This module includes authentication, text-to-image generation, and image-editing endpoints.
 """
 
-from flask import Flask, request, jsonify, render_template_string, render_template, redirect, url_for, session, Response, flash
+from flask import Flask, request, jsonify, render_template_string, render_template, redirect, url_for, session, Response, flash, has_request_context, copy_current_request_context
 from flask_cors import CORS
 from IPython.display import Image as IPyImage
 from google import genai
-from google.genai.types import GenerateContentConfig, Part
+from google.genai.types import GenerateContentConfig, HttpOptions, Part, ThinkingConfig
 from PIL import Image, ImageEnhance
 # from insightface.app import FaceAnalysis
 import numpy as np
 import cv2
-from vertexai.generative_models import GenerativeModel
 from typing import Optional
 from functools import wraps
-from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from cachetools import TTLCache
+from datetime import datetime, timedelta, timezone
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request
 from vertexai.preview.vision_models import ImageGenerationModel
 import vertexai
 import requests
 import base64
+import httpx
+import json
+import queue
+import threading
 import uuid
 import tempfile
 import time
-from urllib.parse import urlparse, unquote
+from urllib.parse import urlparse, unquote, urljoin
 import os 
 from dotenv import load_dotenv
 
@@ -46,6 +51,21 @@ if not os.getenv("RAILWAY_ENVIRONMENT"):
 else:
     print("🚀 Running on Railway — using environment variables")
 
+# Imported after .env is loaded so callback and quota settings are picked up
+try:
+    from .callbacks import callbacks_enabled, create_callback_job, ensure_callback_worker, \
+        finish_callback_job, is_valid_callback_url
+    from . import scheduler
+    from .scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STANDARD, \
+        QuotaTimeoutError, bulk_slot, call_model, is_quota_error, quota_status, session_usage
+except ImportError:
+    # Running as a script (python app.py)
+    from callbacks import callbacks_enabled, create_callback_job, ensure_callback_worker, \
+        finish_callback_job, is_valid_callback_url
+    import scheduler
+    from scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STANDARD, \
+        QuotaTimeoutError, bulk_slot, call_model, is_quota_error, quota_status, session_usage
+
 # Get GCP configuration from environment
 PROJECT_ID = os.getenv("PROJECT_ID")
 LOCATION = os.getenv("LOCATION", "us-central1")
@@ -115,8 +135,27 @@ ENDPOINT = f"https://{LOCATION}-aiplatform.googleapis.com/v1/projects/{PROJECT_I
 # SuperAdmin OTP
 SUPERADMIN_OTP = os.getenv("SUPERADMIN_OTP")
 
-# Initialize Gemini model for prompt refinement
-gemini = GenerativeModel("gemini-2.5-pro")
+# Gemini model for prompt refinement
+REFINE_MODEL_ID = "gemini-2.5-pro"
+
+# Prompt refinement: cache of refined prompts and micro-batching of Gemini calls
+REFINE_CACHE_SIZE = int(os.getenv("PROMPT_REFINE_CACHE_SIZE", "512"))
+REFINE_CACHE_TTL = float(os.getenv("PROMPT_REFINE_CACHE_TTL", "3600"))
+REFINE_FAILURE_TTL = float(os.getenv("PROMPT_REFINE_FAILURE_TTL", "60"))
+REFINE_TIMEOUT = float(os.getenv("PROMPT_REFINE_TIMEOUT", "8"))
+# The Gemini call itself may outlive the caller's wait so a slow refinement still reaches the cache
+REFINE_CALL_TIMEOUT = float(os.getenv("PROMPT_REFINE_CALL_TIMEOUT", "45"))
+REFINE_THINKING_BUDGET = int(os.getenv("PROMPT_REFINE_THINKING_BUDGET", "128"))
+REFINE_MAX_OUTPUT_TOKENS = int(os.getenv("PROMPT_REFINE_MAX_OUTPUT_TOKENS", "4096"))
+REFINE_CONCURRENCY = int(os.getenv("PROMPT_REFINE_CONCURRENCY", "4"))
+REFINE_BATCH_WINDOW = float(os.getenv("PROMPT_REFINE_BATCH_WINDOW", "0.05"))
+REFINE_BATCH_SIZE = int(os.getenv("PROMPT_REFINE_BATCH_SIZE", "8"))
+
+# Background jobs for requests with a callback_url (delivery settings live in callbacks.py)
+CALLBACK_JOB_WORKERS = int(os.getenv("CALLBACK_JOB_WORKERS", "4"))
+
+# Generated images are written to /static in chunks of this size
+IMAGE_WRITE_CHUNK = 1024 * 1024
 
 # Face detection (lazy load)
 # _face_app = None
@@ -338,6 +377,475 @@ gemini = GenerativeModel("gemini-2.5-pro")
 #     except Exception as e:
 #         print(f"⚠️ Skin preservation failed: {e}")
 
+DIRECTIVE_PROMPT_HEADER = "IDENTITY PRESERVATION: Maintain exact facial features.\nCHANGE REQUEST: "
+DIRECTIVE_PROMPT_CONSTRAINTS = """
+CONSTRAINTS:
+- Do NOT alter skin tone or facial structure
+- Only modify elements explicitly mentioned
+- Preserve realism and consistent lighting
+- Professional studio photo quality"""
+
+REFINE_BATCH_INSTRUCTION = """You are a prompt engineer for Google Vertex AI image generation and editing models.
+Rewrite each prompt in the JSON array below to be:
+1. FAITHFUL to the user's intent and every subject they mention
+2. EXPLICIT about layout, lighting and style using professional photography terminology
+3. SPECIFIC about what NOT to include (e.g., no extra objects, no text artifacts)
+
+CRITICAL RULES:
+- Keep each rewritten prompt under 200 words
+- Return ONLY a JSON array of strings with exactly one rewritten prompt per input, in the same order
+
+Prompts: """
+
+_refine_cache = TTLCache(maxsize=REFINE_CACHE_SIZE, ttl=REFINE_CACHE_TTL)
+# Prompts whose refinement recently failed go straight to the fallback
+_refine_failures = TTLCache(maxsize=REFINE_CACHE_SIZE, ttl=REFINE_FAILURE_TTL)
+_refine_pool = ThreadPoolExecutor(max_workers=REFINE_CONCURRENCY, thread_name_prefix="prompt-refine")
+_refine_pending: dict[str, Future] = {}
+_refine_lock = threading.Lock()
+_refine_queue: "queue.Queue[tuple[str, str, Future, Optional[str]]]" = queue.Queue()
+_refine_worker: Optional[threading.Thread] = None
+
+
+def build_directive_prompt(instruction: str) -> str:
+    """Wrap a chat-edit instruction in the identity-preserving directive template."""
+    return DIRECTIVE_PROMPT_HEADER + instruction + DIRECTIVE_PROMPT_CONSTRAINTS
+
+
+def is_truthy(value) -> bool:
+    """Interpret a JSON or form-data flag such as ``true``, ``"1"`` or ``"yes"``."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def _normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace and case so equivalent prompts share a cache entry."""
+    return " ".join(prompt.split()).casefold()
+
+
+def _run_refine_batch(batch: list[tuple[str, str, Future, Optional[str]]]) -> None:
+    """Refine a batch of prompts with a single Gemini call and resolve their futures.
+
+    The call never queues for quota and is bounded by ``REFINE_CALL_TIMEOUT``. Callers
+    stop waiting after ``REFINE_TIMEOUT`` but the call keeps running, so a slow
+    refinement is still cached for the next request. Only real errors (not timeouts
+    or exhausted quota) put prompts on the failure list.
+    """
+    remember_failure = True
+    try:
+        response = call_model(
+            REFINE_MODEL_ID,
+            client.models.generate_content,
+            queue_timeout=0,
+            max_retries=0,
+            session_ids=[session_id for *_, session_id in batch],
+            model=REFINE_MODEL_ID,
+            contents=REFINE_BATCH_INSTRUCTION + json.dumps([prompt for _, prompt, *_ in batch]),
+            config=GenerateContentConfig(
+                response_mime_type="application/json",
+                thinking_config=ThinkingConfig(thinking_budget=REFINE_THINKING_BUDGET),
+                max_output_tokens=REFINE_MAX_OUTPUT_TOKENS,
+                http_options=HttpOptions(timeout=int(REFINE_CALL_TIMEOUT * 1000)),
+            ),
+        )
+        refined = json.loads(getattr(response, "text", "") or "[]")
+        if not isinstance(refined, list) or len(refined) != len(batch):
+            raise ValueError(
+                f"expected {len(batch)} refined prompts, got {len(refined) if isinstance(refined, list) else 'non-list'}")
+    except (httpx.TimeoutException, TimeoutError, QuotaTimeoutError) as e:
+        print(f"⚠️ Gemini batch refinement timed out or was rate limited: {e}")
+        refined = [None] * len(batch)
+        remember_failure = False
+    except Exception as e:
+        print(f"⚠️ Gemini batch refinement failed: {e}")
+        refined = [None] * len(batch)
+        remember_failure = not is_quota_error(e)
+
+    for (key, _, future, _), text in zip(batch, refined):
+        text = text.strip() if isinstance(text, str) else ""
+        with _refine_lock:
+            _refine_pending.pop(key, None)
+            if len(text) >= 10:
+                _refine_cache[key] = text
+            elif remember_failure:
+                _refine_failures[key] = True
+        if len(text) >= 10:
+            future.set_result(text)
+        else:
+            future.set_exception(ValueError("Gemini returned an empty refinement"))
+
+
+def _refine_batch_loop() -> None:
+    """Collect refinement requests for a short window and hand each batch to the refine pool."""
+    while True:
+        batch = [_refine_queue.get()]
+        deadline = time.monotonic() + REFINE_BATCH_WINDOW
+        while len(batch) < REFINE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_refine_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        print(f"🧠 Refining {len(batch)} prompt(s) with Gemini 2.5 Pro...")
+        _refine_pool.submit(_run_refine_batch, batch)
+
+
+def refine_prompt(raw_prompt: str, timeout: float = REFINE_TIMEOUT) -> str:
+    """Refine a prompt with Gemini 2.5 Pro, falling back to the raw prompt.
+
+    Refinements are memoized in a TTL cache keyed on the normalized prompt, and
+    concurrent requests are micro-batched into a single Gemini call. Identical
+    prompts already in flight share one refinement, and prompts whose refinement
+    failed fall back immediately for ``REFINE_FAILURE_TTL`` seconds. A caller that
+    stops waiting leaves the Gemini call running so its result is still cached.
+
+    Args:
+        raw_prompt (str): The user's prompt.
+        timeout (float): Seconds to wait for Gemini before falling back.
+
+    Returns:
+        str: The refined prompt, or ``raw_prompt`` on timeout or failure.
+    """
+    global _refine_worker
+
+    key = _normalize_prompt(raw_prompt)
+    if not key:
+        return raw_prompt
+
+    with _refine_lock:
+        cached = _refine_cache.get(key)
+        if cached is not None:
+            return cached
+        if key in _refine_failures:
+            return raw_prompt
+
+        future = _refine_pending.get(key)
+        if future is None:
+            future = Future()
+            _refine_pending[key] = future
+            _refine_queue.put((key, raw_prompt.strip(), future, _current_session_id()))
+
+        if _refine_worker is None or not _refine_worker.is_alive():
+            _refine_worker = threading.Thread(
+                target=_refine_batch_loop, name="prompt-refiner", daemon=True)
+            _refine_worker.start()
+
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        print(f"⚠️ Gemini refinement timed out after {timeout}s, using local template")
+    except Exception as e:
+        print(f"⚠️ Gemini refinement failed: {e}")
+    return raw_prompt
+
+
+def _current_session_id() -> Optional[str]:
+    """Return a stable id for the current browser session, if called within a request."""
+    if not has_request_context():
+        return None
+    if "sid" not in session:
+        session["sid"] = uuid.uuid4().hex
+    return session["sid"]
+
+
+# Bill model calls to the browser session that made the request
+scheduler.session_resolver = _current_session_id
+
+
+def quota_exceeded_response(error: QuotaTimeoutError) -> Response:
+    """Build the 429 response returned when the scheduler gives up on a call."""
+    print(f"⏳ {error}")
+    return jsonify({"error": str(error)}), 429, {"Retry-After": "60"}
+
+
+_callback_jobs = ThreadPoolExecutor(
+    max_workers=CALLBACK_JOB_WORKERS, thread_name_prefix="callback-job")
+
+
+def submit_callback_job(callback_url: str, kind: str, metadata: dict, work, *args) -> str:
+    """Run ``work(*args)`` in the background and POST its result manifest to ``callback_url``.
+
+    ``work`` must return a list of ``/static`` image URLs. Must be called within a
+    request; the request context is carried into the job for quota accounting and
+    to build absolute image URLs. The job is recorded in the callback queue before
+    this returns, so a worker restart mid-job is reported to the receiver as a failure.
+
+    Returns:
+        str: The job id echoed in the 202 response and the callback manifest.
+    """
+    job_id = uuid.uuid4().hex
+    base_url = request.host_url
+    queued_at = datetime.now(timezone.utc)
+    _current_session_id()
+    create_callback_job(job_id, callback_url, {
+        "job_id": job_id,
+        "kind": kind,
+        "metadata": metadata,
+        "timings": {"queued_at": queued_at.isoformat()},
+    })
+
+    @copy_current_request_context
+    def run_job() -> None:
+        started_at = datetime.now(timezone.utc)
+        manifest = {"job_id": job_id, "kind": kind, "metadata": metadata}
+        try:
+            image_urls = work(*args)
+            manifest["status"] = "succeeded"
+            manifest["image_urls"] = [urljoin(base_url, url) for url in image_urls]
+        except Exception as e:
+            print(f"❌ Callback job {job_id} failed: {e}")
+            manifest["status"] = "failed"
+            manifest["error"] = str(e)
+            manifest["image_urls"] = []
+
+        completed_at = datetime.now(timezone.utc)
+        manifest["timings"] = {
+            "queued_at": queued_at.isoformat(),
+            "started_at": started_at.isoformat(),
+            "completed_at": completed_at.isoformat(),
+            "queue_ms": int((started_at - queued_at).total_seconds() * 1000),
+            "duration_ms": int((completed_at - started_at).total_seconds() * 1000),
+        }
+        finish_callback_job(callback_url, manifest)
+
+    _callback_jobs.submit(run_job)
+    print(f"📨 Accepted {kind} job {job_id}; result will be POSTed to {callback_url}")
+    return job_id
+
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+)
+IMAGE_MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+
+def sniff_image_extension(data: memoryview) -> Optional[str]:
+    """Identify PNG, JPEG, GIF or WebP bytes from their header without decoding the image.
+
+    Returns:
+        Optional[str]: The file extension, or None if the bytes are not a known image format.
+    """
+    for signature, extension in IMAGE_SIGNATURES:
+        if data[:len(signature)] == signature:
+            return extension
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+def input_mime_type(data, declared: Optional[str] = None) -> str:
+    """Pick the mime type to send with an input image.
+
+    Uses the type sniffed from the image header, then the uploader's declared
+    ``image/*`` type, then PNG.
+    """
+    extension = sniff_image_extension(memoryview(data).cast("B"))
+    if extension is not None:
+        return IMAGE_MIME_TYPES[extension]
+    if declared and declared.startswith("image/"):
+        return declared
+    return "image/png"
+
+
+def _static_output(prefix: str, extension: str) -> tuple[str, str]:
+    """Reserve a new file in ``/static``.
+
+    Returns:
+        tuple[str, str]: The file path and its cache-busted URL.
+    """
+    static_dir = os.path.join(os.path.dirname(__file__), "static")
+    os.makedirs(static_dir, exist_ok=True)
+    filename = f"{prefix}_{uuid.uuid4().hex}{extension}"
+    return os.path.join(static_dir, filename), f"/static/{filename}?v={int(time.time())}"
+
+
+def save_image_bytes(data, prefix: str) -> str:
+    """Validate image bytes by header and stream them into ``/static`` without copying.
+
+    Args:
+        data (bytes-like): Encoded image bytes from the model response.
+        prefix (str): Filename prefix, e.g. ``"edited"``.
+
+    Returns:
+        str: Cache-busted ``/static`` URL of the saved image.
+
+    Raises:
+        ValueError: If the bytes are not a PNG, JPEG, GIF or WebP image.
+    """
+    view = memoryview(data).cast("B")
+    extension = sniff_image_extension(view)
+    if extension is None:
+        raise ValueError(f"unrecognized image data ({len(view)} bytes)")
+
+    output_path, url = _static_output(prefix, extension)
+
+    # Unbuffered writes of memoryview slices go straight from the response buffer to the file
+    with open(output_path, "wb", buffering=0) as f:
+        offset = 0
+        while offset < len(view):
+            offset += f.write(view[offset:offset + IMAGE_WRITE_CHUNK])
+
+    return url
+
+
+def save_imagen_image(img, prefix: str) -> str:
+    """Save an Imagen result to ``/static`` and validate it by header.
+
+    ``include_generation_parameters=False`` makes the SDK write the encoded bytes
+    as-is; the default decodes and re-encodes the image through PIL to embed the
+    generation parameters as EXIF, which are therefore not stored in the file.
+
+    Returns:
+        str: Cache-busted ``/static`` URL of the saved image.
+
+    Raises:
+        ValueError: If the saved file is not a PNG image.
+    """
+    output_path, url = _static_output(prefix, ".png")
+    img.save(output_path, include_generation_parameters=False)
+
+    with open(output_path, "rb") as f:
+        header = f.read(16)
+    if sniff_image_extension(memoryview(header)) != ".png":
+        os.remove(output_path)
+        raise ValueError("Imagen returned data that is not a PNG image")
+
+    return url
+
+
+def save_response_images(response, prefix: str) -> list[str]:
+    """Save every inline image from every candidate of a Gemini response.
+
+    Parts that are not valid images are reported and skipped; if nothing usable
+    was returned the call fails instead of producing an empty result.
+
+    Returns:
+        list[str]: Cache-busted ``/static`` URLs, in candidate and part order.
+
+    Raises:
+        ValueError: If the response contains no valid images.
+    """
+    image_urls = []
+    problems = []
+    for index, candidate in enumerate(getattr(response, "candidates", None) or []):
+        content = getattr(candidate, "content", None)
+        parts = getattr(content, "parts", None) or []
+        for part in parts:
+            inline_data = getattr(part, "inline_data", None)
+            if inline_data is None or not inline_data.data:
+                continue
+            try:
+                image_urls.append(save_image_bytes(inline_data.data, prefix))
+            except ValueError as e:
+                print(f"⚠️ Skipping candidate {index} part ({inline_data.mime_type}): {e}")
+                problems.append(str(e))
+
+        if not parts:
+            finish_reason = getattr(candidate, "finish_reason", None)
+            problems.append(f"candidate {index} returned no content (finish_reason={finish_reason})")
+
+    if not image_urls:
+        detail = "; ".join(problems) or "no candidates"
+        raise ValueError(f"Model returned no images: {detail}")
+
+    return image_urls
+
+
+def generate_with_imagen(prompt: str, number_of_images: int, aspect_ratio: str,
+                         negative_prompt: str, refine: bool = False) -> list[str]:
+    """Generate images with Imagen 4.0 and save them to ``/static``.
+
+    Returns:
+        list[str]: Cache-busted ``/static`` URLs of the generated images.
+    """
+    if refine:
+        prompt = refine_prompt(prompt)
+
+    # Load Imagen model
+    model = ImageGenerationModel.from_pretrained("imagen-4.0-generate-001")
+
+    # Generate image
+    result = call_model(
+        "imagen-4.0-generate-001",
+        model.generate_images,
+        priority=PRIORITY_BULK,
+        prompt=prompt,
+        number_of_images=number_of_images,
+        aspect_ratio=aspect_ratio,
+        negative_prompt=negative_prompt,
+        person_generation="allow_all",
+        safety_filter_level="block_few",
+        add_watermark=True,
+        output_mime_type="image/png",
+    )
+
+    # Save image to static folder
+    image_urls = [save_imagen_image(img, "generated") for img in result.images]
+    if not image_urls:
+        raise ValueError("Imagen returned no images (all results may have been filtered)")
+
+    return image_urls
+
+
+def compose_with_gemini(prompt: str, images: list[tuple[bytes, Optional[str]]],
+                        refine: bool = False) -> list[str]:
+    """Combine several images into one composition with Gemini 2.5 Flash Image.
+
+    Args:
+        prompt (str): How to combine the images.
+        images (list[tuple[bytes, Optional[str]]]): Image bytes with the uploader's declared mime type.
+        refine (bool): Rewrite the prompt with Gemini 2.5 Pro first.
+
+    Returns:
+        list[str]: Cache-busted ``/static`` URLs of the composed image(s).
+    """
+    if refine:
+        prompt = refine_prompt(prompt)
+
+    parts = [{"text": prompt}]
+    for img_bytes, declared_type in images:
+        parts.append({
+            "inline_data": {
+                "mime_type": input_mime_type(img_bytes, declared_type),
+                "data": img_bytes
+            }
+        })
+
+    print(
+        f"🧩 Composing {len(images)} images with Gemini 2.5 Flash Image...")
+
+    response = call_model(
+        "gemini-2.5-flash-image",
+        client.models.generate_content,
+        priority=PRIORITY_STANDARD,
+        model="gemini-2.5-flash-image",
+        contents=[{"role": "user", "parts": parts}],
+        config=GenerateContentConfig(
+            response_modalities=["IMAGE"],
+            candidate_count=1,
+        ),
+    )
+
+    image_urls = save_response_images(response, "composed")
+    print(f"✅ Composition created: {', '.join(image_urls)}")
+    return image_urls
+
+
+# Resume deliveries and fail jobs left in the queue by a previous worker
+ensure_callback_worker()
+
+
 def login_required(f):
     """Decorator that restricts access to logged-in admin users."""
     from functools import wraps
@@ -466,50 +974,52 @@ def generate_image() -> Response:
         number_of_images (int, optional): Number of images to generate (default=1).
         aspect_ratio (str, optional): Aspect ratio, e.g. "1:1" or "16:9".
         negative_prompt (str, optional): Objects/concepts to avoid.
+        refine_prompt (bool, optional): Rewrite the prompt with Gemini 2.5 Pro first (default=false).
+        callback_url (str, optional): Return 202 immediately and POST the result manifest here.
 
     Returns:
-        Response: JSON containing a list of image URLs or an error message.
+        Response: JSON containing a list of image URLs, a 202 job acknowledgement, or an error message.
     """
     try:
         data = request.get_json()
         prompt = data.get("prompt")
-        number_of_images = data.get("number_of_images", "1")
+        number_of_images = int(data.get("number_of_images", "1"))
         aspect_ratio = data.get("aspect_ratio", "1:1")
         negative_prompt = data.get("negative_prompt", "")
+        refine = is_truthy(data.get("refine_prompt", False))
+        callback_url = data.get("callback_url")
 
         if not prompt:
             return jsonify({"error": "No prompt provided"}), 400
 
-        # Load Imagen model
-        model = ImageGenerationModel.from_pretrained("imagen-4.0-generate-001")
-
-        # Generate image
-        result = model.generate_images(
-            prompt=prompt,
-            number_of_images=int(number_of_images),
-            aspect_ratio=aspect_ratio,
-            negative_prompt=negative_prompt,
-            person_generation="allow_all",
-            safety_filter_level="block_few",
-            add_watermark=True,
-        )
-
-        # Save image to static folder
-        image_urls = []
-        for img in result.images:
-            static_dir = os.path.join(os.path.dirname(__file__), "static")
-            os.makedirs(static_dir, exist_ok=True)
-            
-            filename = f"generated_{uuid.uuid4().hex}.png"
-            output_path = os.path.join(static_dir, filename)
-            img.save(output_path)
-
-            filename = os.path.basename(output_path)
-            image_urls.append(f"/static/{filename}?v={int(time.time())}")
+        if callback_url is not None:
+            if not callbacks_enabled():
+                return jsonify({"error": "Callbacks are disabled: CALLBACK_SIGNING_SECRET is not configured"}), 400
+            if not is_valid_callback_url(callback_url):
+                return jsonify({"error": "callback_url must be an absolute http(s) URL"}), 400
+
+            metadata = {
+                "model": "imagen-4.0-generate-001",
+                "prompt": prompt,
+                "number_of_images": number_of_images,
+                "aspect_ratio": aspect_ratio,
+                "negative_prompt": negative_prompt,
+                "refine_prompt": refine,
+            }
+            job_id = submit_callback_job(
+                callback_url, "generate", metadata, generate_with_imagen,
+                prompt, number_of_images, aspect_ratio, negative_prompt, refine)
+            return jsonify({"job_id": job_id, "status": "accepted"}), 202
+
+        with bulk_slot():
+            image_urls = generate_with_imagen(
+                prompt, number_of_images, aspect_ratio, negative_prompt, refine)
 
         # Return image URL with timestamp (cache-buster)
         return jsonify({"image_urls": image_urls})
 
+    except QuotaTimeoutError as e:
+        return quota_exceeded_response(e)
     except Exception as e:
         print("Error:", str(e))
         return jsonify({"error": str(e)}), 500
@@ -525,6 +1035,7 @@ def edit_image() -> Response:
         image (file): The uploaded image file to modify.
         prompt (str): The description of desired changes.
         number_of_images (int, optional): Number of variations to generate.
+        refine_prompt (bool, optional): Rewrite the prompt with Gemini 2.5 Pro first (default=false).
 
     Returns:
         Response: JSON containing a list of edited image URLs.
@@ -534,6 +1045,9 @@ def edit_image() -> Response:
         if "image" not in request.files:
             return jsonify({"error": "No image uploaded"}), 400
 
+        if is_truthy(request.form.get("refine_prompt", False)):
+            raw_prompt = refine_prompt(raw_prompt)
+
         uploaded = request.files["image"]
         temp_path = os.path.join(
             tempfile.gettempdir(), f"upload_{uuid.uuid4().hex}.png")
@@ -544,12 +1058,15 @@ def edit_image() -> Response:
 
         print(f"🖌️ Editing with Gemini 2.5 Flash Image...")
 
-        response = client.models.generate_content(
+        response = call_model(
+            "gemini-2.5-flash-image",
+            client.models.generate_content,
+            priority=PRIORITY_STANDARD,
             model="gemini-2.5-flash-image",
             contents=[
                 {"role": "user", "parts": [
                     {"text": raw_prompt},
-                    {"inline_data": {"mime_type": "image/png", "data": image_bytes}}
+                    {"inline_data": {"mime_type": input_mime_type(image_bytes, uploaded.mimetype), "data": image_bytes}}
                 ]}
             ],
             config=GenerateContentConfig(
@@ -558,19 +1075,13 @@ def edit_image() -> Response:
             ),
         )
 
-        static_dir = os.path.join(os.path.dirname(__file__), "static")
-        os.makedirs(static_dir, exist_ok=True)
-        filename = f"edited_{uuid.uuid4().hex}.png"
-        output_path = os.path.join(static_dir, filename)
-
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, "inline_data"):
-                with open(output_path, "wb") as f:
-                    f.write(part.inline_data.data)
+        image_urls = save_response_images(response, "edited")
 
-        print(f"✅ Edit successful: {output_path}")
-        return jsonify({"image_urls": [f"/static/{filename}?v={int(time.time())}"]})
+        print(f"✅ Edit successful: {', '.join(image_urls)}")
+        return jsonify({"image_urls": image_urls})
 
+    except QuotaTimeoutError as e:
+        return quota_exceeded_response(e)
     except Exception as e:
         print(f"❌ Edit error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -578,7 +1089,13 @@ def edit_image() -> Response:
 
 @app.route("/chat_edit", methods=["POST"])
 def chat_edit() -> Response:
-    """Iterative editing via chat interface using Gemini 2.5 Flash Image."""
+    """Iterative editing via chat interface using Gemini 2.5 Flash Image.
+
+    Request Body (JSON):
+        instruction (str): The change to apply to the current image.
+        image_path (str): URL or path of the image to refine.
+        refine_prompt (bool, optional): Rewrite the instruction with Gemini 2.5 Pro first (default=false).
+    """
     try:
         data = request.get_json()
         instruction = data.get("instruction", "")
@@ -604,14 +1121,10 @@ def chat_edit() -> Response:
                     "error": f"Image not found: {clean_path}. Please re-upload or re-generate before refining."
                 }), 404
 
-        # 🔹 Prepare directive prompt
-        directive_prompt = f"""IDENTITY PRESERVATION: Maintain exact facial features.
-CHANGE REQUEST: {instruction}
-CONSTRAINTS:
-- Do NOT alter skin tone or facial structure
-- Only modify elements explicitly mentioned
-- Preserve realism and consistent lighting
-- Professional studio photo quality"""
+        # 🔹 Prepare directive prompt (optionally refined by Gemini)
+        if is_truthy(data.get("refine_prompt", False)):
+            instruction = refine_prompt(instruction)
+        directive_prompt = build_directive_prompt(instruction)
 
         print("🧠 Gemini 2.5 Flash Image chat-edit in progress...")
 
@@ -620,14 +1133,17 @@ CONSTRAINTS:
             image_bytes = f.read()
 
         # 🔹 Generate new version using Gemini 2.5 Flash Image
-        response = client.models.generate_content(
+        response = call_model(
+            "gemini-2.5-flash-image",
+            client.models.generate_content,
+            priority=PRIORITY_INTERACTIVE,
             model="gemini-2.5-flash-image",
             contents=[
                 {
                     "role": "user",
                     "parts": [
                         {"text": directive_prompt},
-                        {"inline_data": {"mime_type": "image/png", "data": image_bytes}}
+                        {"inline_data": {"mime_type": input_mime_type(image_bytes), "data": image_bytes}}
                     ],
                 }
             ],
@@ -637,20 +1153,14 @@ CONSTRAINTS:
             ),
         )
 
-        # 🔹 Save edited image in /static
-        static_dir = os.path.join(os.path.dirname(__file__), "static")
-        os.makedirs(static_dir, exist_ok=True)
-        filename = f"chat_edit_{uuid.uuid4().hex}.png"
-        output_path = os.path.join(static_dir, filename)
-
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, "inline_data"):
-                with open(output_path, "wb") as f:
-                    f.write(part.inline_data.data)
+        # 🔹 Save every edited image in /static
+        image_urls = save_response_images(response, "chat_edit")
 
-        print(f"✅ Chat-edit successful: {output_path}")
-        return jsonify({"image_url": f"/static/{filename}?v={int(time.time())}"})
+        print(f"✅ Chat-edit successful: {', '.join(image_urls)}")
+        return jsonify({"image_url": image_urls[0], "image_urls": image_urls})
 
+    except QuotaTimeoutError as e:
+        return quota_exceeded_response(e)
     except Exception as e:
         print(f"❌ Chat-edit error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -662,54 +1172,63 @@ def compose_images():
     Combine multiple uploaded images into one composition.
     Example prompt:
       "Make an action figure of the person on the left and the accessories on the right in a blister package."
+
+    Pass ``refine_prompt=true`` in the form data to rewrite the prompt with Gemini 2.5 Pro first,
+    and ``callback_url`` to return 202 immediately and have the result manifest POSTed there.
     """
     try:
         prompt = request.form.get("prompt", "").strip()
         uploads = request.files.getlist("images")
+        refine = is_truthy(request.form.get("refine_prompt", False))
+        callback_url = request.form.get("callback_url")
 
         if not uploads or not prompt:
             return jsonify({"error": "Please upload images and provide a prompt"}), 400
 
-        parts = [{"text": prompt}]
-        for img in uploads:
-            img_bytes = img.read()
-            parts.append({
-                "inline_data": {
-                    "mime_type": "image/png",
-                    "data": img_bytes
-                }
-            })
-
-        print(
-            f"🧩 Composing {len(uploads)} images with Gemini 2.5 Flash Image...")
-
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-image",
-            contents=[{"role": "user", "parts": parts}],
-            config=GenerateContentConfig(
-                response_modalities=["IMAGE"],
-                candidate_count=1,
-            ),
-        )
-
-        static_dir = os.path.join(os.path.dirname(__file__), "static")
-        os.makedirs(static_dir, exist_ok=True)
-        filename = f"composed_{uuid.uuid4().hex}.png"
-        output_path = os.path.join(static_dir, filename)
-
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, "inline_data"):
-                with open(output_path, "wb") as f:
-                    f.write(part.inline_data.data)
-
-        print(f"✅ Composition created: {output_path}")
-        return jsonify({"image_url": f"/static/{filename}?v={int(time.time())}"})
-
+        images = [(img.read(), img.mimetype) for img in uploads]
+
+        if callback_url is not None:
+            if not callbacks_enabled():
+                return jsonify({"error": "Callbacks are disabled: CALLBACK_SIGNING_SECRET is not configured"}), 400
+            if not is_valid_callback_url(callback_url):
+                return jsonify({"error": "callback_url must be an absolute http(s) URL"}), 400
+
+            metadata = {
+                "model": "gemini-2.5-flash-image",
+                "prompt": prompt,
+                "input_images": len(images),
+                "refine_prompt": refine,
+            }
+            job_id = submit_callback_job(
+                callback_url, "compose", metadata, compose_with_gemini, prompt, images, refine)
+            return jsonify({"job_id": job_id, "status": "accepted"}), 202
+
+        image_urls = compose_with_gemini(prompt, images, refine)
+        return jsonify({"image_url": image_urls[0], "image_urls": image_urls})
+
+    except QuotaTimeoutError as e:
+        return quota_exceeded_response(e)
     except Exception as e:
         print(f"❌ Composition error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/usage")
+def usage() -> Response:
+    """Report the current session's model usage and cost alongside remaining model quota.
+
+    Returns:
+        Response: JSON with per-model ``session`` usage (calls, images, input_tokens,
+        output_tokens, cost_usd, latency_s) and ``quota`` state (rpm, remaining, queued).
+    """
+    by_model = session_usage(_current_session_id())
+    return jsonify({
+        "session": by_model,
+        "total_cost_usd": round(sum(m["cost_usd"] for m in by_model.values()), 6),
+        "quota": quota_status(),
+    })
+
+
 @app.route("/logout")
 def logout() -> Response:
     """Log out the current admin session."""
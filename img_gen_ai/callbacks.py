@@ -0,0 +1,394 @@
+"""
+Callback Delivery
+-----------------
+Durable webhook delivery for ``/generate`` and ``/compose`` jobs submitted with a ``callback_url``.
+
+Jobs and their result manifests live in a SQLite queue (``CALLBACK_QUEUE_PATH``) shared by all
+worker processes:
+
+- ``queued``: the job was accepted (202) and is still running. The owning process renews its
+  lease from a dedicated thread; if the process dies, the job is reported to the receiver as
+  failed and any result the job produces later is dropped.
+- ``pending`` / ``delivering``: the manifest is waiting for, or in, a delivery attempt.
+- ``failed``: delivery gave up; kept for ``CALLBACK_RETENTION`` seconds for inspection.
+
+Deliveries are POSTed through a pooled keep-alive ``requests`` session and signed with
+HMAC-SHA256 using ``CALLBACK_SIGNING_SECRET``. This module does not need GCP credentials, so it
+can be imported and tested on its own.
+"""
+
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from typing import Optional
+from urllib.parse import urlparse
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import requests
+
+CALLBACK_QUEUE_PATH = os.getenv(
+    "CALLBACK_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "img_gen_ai_callbacks.sqlite3"))
+CALLBACK_SIGNING_SECRET = os.getenv("CALLBACK_SIGNING_SECRET", "")
+CALLBACK_TIMEOUT = float(os.getenv("CALLBACK_TIMEOUT", "10"))
+CALLBACK_MAX_ATTEMPTS = int(os.getenv("CALLBACK_MAX_ATTEMPTS", "8"))
+CALLBACK_POOL_SIZE = int(os.getenv("CALLBACK_POOL_SIZE", "10"))
+CALLBACK_JOB_LEASE = float(os.getenv("CALLBACK_JOB_LEASE", "90"))
+CALLBACK_RETENTION = float(os.getenv("CALLBACK_RETENTION", str(7 * 24 * 3600)))
+
+# A single attempt is bounded by the connect and read timeouts (no transport-level retries),
+# so a delivery lease of twice the timeout plus slack cannot expire mid-attempt
+DELIVERY_LEASE = CALLBACK_TIMEOUT * 2 + 30
+
+_wakeup = threading.Event()
+_lock = threading.Lock()
+_http_session: Optional[requests.Session] = None
+_worker: Optional[threading.Thread] = None
+_lease_worker: Optional[threading.Thread] = None
+_inflight_jobs: set[str] = set()
+
+
+def callbacks_enabled() -> bool:
+    """Return True if a signing secret is configured, which callbacks require."""
+    return bool(CALLBACK_SIGNING_SECRET)
+
+
+def is_valid_callback_url(url) -> bool:
+    """Return True if ``url`` is an absolute http(s) URL."""
+    if not isinstance(url, str):
+        return False
+    parsed = urlparse(url)
+    return parsed.scheme in ("http", "https") and bool(parsed.netloc)
+
+
+def sign_callback(body: bytes, timestamp: str) -> str:
+    """Compute the ``X-ImgGen-Signature`` value for a callback body.
+
+    Receivers verify a delivery by computing HMAC-SHA256 over ``"<timestamp>.<body>"``
+    with the shared ``CALLBACK_SIGNING_SECRET`` and comparing it to the header.
+
+    Raises:
+        RuntimeError: If ``CALLBACK_SIGNING_SECRET`` is not set.
+    """
+    if not CALLBACK_SIGNING_SECRET:
+        raise RuntimeError("CALLBACK_SIGNING_SECRET is not set")
+    digest = hmac.new(CALLBACK_SIGNING_SECRET.encode(),
+                      timestamp.encode() + b"." + body, hashlib.sha256)
+    return f"sha256={digest.hexdigest()}"
+
+
+def _callback_http() -> requests.Session:
+    """Lazily create the pooled keep-alive session used for callback delivery.
+
+    Retries are left to the queue (with backoff and a fresh lease per attempt) rather
+    than urllib3, so one attempt never outlives its lease.
+    """
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            adapter = HTTPAdapter(
+                pool_connections=CALLBACK_POOL_SIZE, pool_maxsize=CALLBACK_POOL_SIZE, max_retries=0)
+            http = requests.Session()
+            http.mount("http://", adapter)
+            http.mount("https://", adapter)
+            _http_session = http
+        return _http_session
+
+
+def _callback_db() -> sqlite3.Connection:
+    """Open the on-disk callback queue, creating it on first use."""
+    conn = sqlite3.connect(CALLBACK_QUEUE_PATH, timeout=30, isolation_level=None)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS callbacks (
+            id TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            body BLOB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            lease_until REAL NOT NULL DEFAULT 0,
+            last_error TEXT
+        )""")
+    return conn
+
+
+def _encode(manifest: dict) -> bytes:
+    """Serialize a manifest exactly as it will be signed and sent."""
+    return json.dumps(manifest, separators=(",", ":")).encode()
+
+
+def deliver_callback(url: str, body: bytes, delivery_id: str) -> requests.Response:
+    """POST a signed callback body to ``url`` over the pooled session.
+
+    Raises:
+        requests.RequestException: If the receiver is unreachable or answers with an error status.
+    """
+    timestamp = str(int(time.time()))
+    response = _callback_http().post(
+        url,
+        data=body,
+        headers={
+            "Content-Type": "application/json",
+            "X-ImgGen-Delivery": delivery_id,
+            "X-ImgGen-Timestamp": timestamp,
+            "X-ImgGen-Signature": sign_callback(body, timestamp),
+        },
+        timeout=(CALLBACK_TIMEOUT, CALLBACK_TIMEOUT),
+    )
+    response.raise_for_status()
+    return response
+
+
+def _is_permanent_failure(error: requests.RequestException) -> bool:
+    """Return True for 4xx answers that will not succeed on retry (everything but 408/429)."""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+def create_callback_job(job_id: str, url: str, manifest: dict) -> None:
+    """Record an accepted job as ``queued`` before its 202 response is sent.
+
+    ``manifest`` is the partial manifest (job id, kind, metadata, ``queued_at``) that is
+    reported as failed if this process dies before calling :func:`finish_callback_job`.
+    """
+    conn = _callback_db()
+    try:
+        conn.execute(
+            """INSERT OR REPLACE INTO callbacks (id, url, body, status, next_attempt_at, lease_until)
+               VALUES (?, ?, ?, 'queued', ?, ?)""",
+            (job_id, url, _encode(manifest), time.time(), time.time() + CALLBACK_JOB_LEASE),
+        )
+    finally:
+        conn.close()
+    with _lock:
+        _inflight_jobs.add(job_id)
+    ensure_callback_worker()
+
+
+def finish_callback_job(url: str, manifest: dict) -> Optional[str]:
+    """Replace a job's ``queued`` row with its final manifest and schedule delivery.
+
+    If the job's lease lapsed and it was already reported as failed, the result is
+    dropped so the receiver never gets two manifests for one delivery id.
+
+    Returns:
+        str | None: The delivery id, or None if the result was dropped.
+    """
+    delivery_id = manifest["job_id"]
+    with _lock:
+        _inflight_jobs.discard(delivery_id)
+
+    conn = _callback_db()
+    try:
+        updated = conn.execute(
+            """UPDATE callbacks SET url = ?, body = ?, status = 'pending', attempts = 0,
+               next_attempt_at = ?, lease_until = 0 WHERE id = ? AND status = 'queued'""",
+            (url, _encode(manifest), time.time(), delivery_id),
+        ).rowcount
+    finally:
+        conn.close()
+    if not updated:
+        print(f"⚠️ Callback job {delivery_id} was already reported as failed; dropping its result")
+        return None
+
+    ensure_callback_worker()
+    _wakeup.set()
+    return delivery_id
+
+
+def enqueue_callback(url: str, manifest: dict) -> str:
+    """Persist a result manifest for delivery to ``url`` and wake the delivery thread.
+
+    Returns:
+        str: The delivery id, sent to the receiver as ``X-ImgGen-Delivery``.
+    """
+    delivery_id = manifest["job_id"]
+    conn = _callback_db()
+    try:
+        conn.execute(
+            """INSERT OR REPLACE INTO callbacks (id, url, body, status, next_attempt_at)
+               VALUES (?, ?, ?, 'pending', ?)""",
+            (delivery_id, url, _encode(manifest), time.time()),
+        )
+    finally:
+        conn.close()
+    ensure_callback_worker()
+    _wakeup.set()
+    return delivery_id
+
+
+def _renew_job_leases(conn: sqlite3.Connection) -> None:
+    """Extend the lease of every job this process is still running."""
+    with _lock:
+        inflight = list(_inflight_jobs)
+    if inflight:
+        conn.execute(
+            f"UPDATE callbacks SET lease_until = ? WHERE status = 'queued' AND id IN ({','.join('?' * len(inflight))})",
+            (time.time() + CALLBACK_JOB_LEASE, *inflight),
+        )
+
+
+def _maintain_queue() -> None:
+    """Renew this process's job leases, fail jobs whose owner died, and prune old failures."""
+    now = time.time()
+    conn = _callback_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        _renew_job_leases(conn)
+
+        interrupted = conn.execute(
+            "SELECT id, body FROM callbacks WHERE status = 'queued' AND lease_until <= ?", (now,)).fetchall()
+        for job_id, body in interrupted:
+            manifest = json.loads(bytes(body))
+            manifest.update(
+                status="failed", image_urls=[], error="Job was interrupted before completion (worker restarted)")
+            manifest.setdefault("timings", {})["completed_at"] = datetime.now(timezone.utc).isoformat()
+            conn.execute(
+                "UPDATE callbacks SET status = 'pending', body = ?, next_attempt_at = ?, lease_until = 0 WHERE id = ?",
+                (_encode(manifest), now, job_id),
+            )
+            print(f"⚠️ Callback job {job_id} was interrupted; reporting it as failed")
+
+        conn.execute(
+            "DELETE FROM callbacks WHERE status = 'failed' AND next_attempt_at <= ?", (now - CALLBACK_RETENTION,))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def _claim_next_callback() -> Optional[tuple[str, str, bytes, int]]:
+    """Atomically lease the next due callback so only one worker delivers it."""
+    now = time.time()
+    conn = _callback_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            """SELECT id, url, body, attempts FROM callbacks
+               WHERE (status = 'pending' AND next_attempt_at <= ?)
+                  OR (status = 'delivering' AND lease_until <= ?)
+               ORDER BY next_attempt_at LIMIT 1""",
+            (now, now),
+        ).fetchone()
+        if row:
+            # Reclaim the lease if this worker dies mid-delivery
+            conn.execute(
+                "UPDATE callbacks SET status = 'delivering', lease_until = ? WHERE id = ?",
+                (now + DELIVERY_LEASE, row[0]),
+            )
+        conn.execute("COMMIT")
+        return row
+    finally:
+        conn.close()
+
+
+def _attempt_delivery(delivery_id: str, url: str, body: bytes, attempts: int) -> None:
+    """Deliver one claimed callback and record the outcome."""
+    try:
+        deliver_callback(url, body, delivery_id)
+    except requests.RequestException as e:
+        attempts += 1
+        permanent = _is_permanent_failure(e)
+        status = "failed" if permanent or attempts >= CALLBACK_MAX_ATTEMPTS else "pending"
+        # Failed rows keep their failure time in next_attempt_at for pruning
+        next_attempt_at = time.time() if status == "failed" else time.time() + min(5 * 2 ** attempts, 600)
+        print(f"⚠️ Callback {delivery_id} to {url} failed ({attempts}/{CALLBACK_MAX_ATTEMPTS}"
+              f"{', not retrying' if permanent else ''}): {e}")
+        conn = _callback_db()
+        try:
+            conn.execute(
+                """UPDATE callbacks SET status = ?, attempts = ?, next_attempt_at = ?,
+                   lease_until = 0, last_error = ? WHERE id = ?""",
+                (status, attempts, next_attempt_at, str(e), delivery_id),
+            )
+        finally:
+            conn.close()
+        return
+
+    conn = _callback_db()
+    try:
+        conn.execute("DELETE FROM callbacks WHERE id = ?", (delivery_id,))
+    finally:
+        conn.close()
+    print(f"📬 Callback {delivery_id} delivered to {url}")
+
+
+def deliver_due_callbacks() -> int:
+    """Run queue maintenance and attempt every callback that is currently due.
+
+    Maintenance is repeated between attempts every third of ``CALLBACK_JOB_LEASE``, so a
+    long backlog of slow receivers cannot hold up lease renewal or failure reporting.
+
+    Returns:
+        int: Number of delivery attempts made.
+    """
+    attempted = 0
+    maintained_at = float("-inf")
+    while True:
+        if time.monotonic() - maintained_at >= CALLBACK_JOB_LEASE / 3:
+            _maintain_queue()
+            maintained_at = time.monotonic()
+        row = _claim_next_callback()
+        if row is None:
+            return attempted
+        delivery_id, url, body, attempts = row
+        _attempt_delivery(delivery_id, url, bytes(body), attempts)
+        attempted += 1
+
+
+def _next_callback_delay() -> float:
+    """Seconds until the earliest pending callback is due, capped so interrupted jobs are noticed."""
+    conn = _callback_db()
+    try:
+        row = conn.execute(
+            "SELECT MIN(next_attempt_at) FROM callbacks WHERE status = 'pending'").fetchone()
+    finally:
+        conn.close()
+    cap = CALLBACK_JOB_LEASE / 3
+    if not row or row[0] is None:
+        return cap
+    return min(max(row[0] - time.time(), 0.0), cap)
+
+
+def _callback_delivery_loop() -> None:
+    """Deliver queued callbacks until the process exits."""
+    while True:
+        try:
+            deliver_due_callbacks()
+            _wakeup.wait(_next_callback_delay())
+            _wakeup.clear()
+        except Exception as e:
+            print(f"❌ Callback delivery loop error: {e}")
+            time.sleep(5)
+
+
+def _lease_renewal_loop() -> None:
+    """Renew this process's job leases on a fixed timer, independent of delivery progress."""
+    while True:
+        try:
+            conn = _callback_db()
+            try:
+                _renew_job_leases(conn)
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"❌ Callback lease renewal error: {e}")
+        time.sleep(CALLBACK_JOB_LEASE / 3)
+
+
+def ensure_callback_worker() -> None:
+    """Start this process's callback delivery and lease renewal threads if they are not running."""
+    global _worker, _lease_worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(
+                target=_callback_delivery_loop, name="callback-delivery", daemon=True)
+            _worker.start()
+        if _lease_worker is None or not _lease_worker.is_alive():
+            _lease_worker = threading.Thread(
+                target=_lease_renewal_loop, name="callback-leases", daemon=True)
+            _lease_worker.start()
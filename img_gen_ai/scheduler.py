@@ -0,0 +1,278 @@
+"""
+Model Scheduler
+---------------
+Per-model quota scheduling and per-session cost accounting for Vertex AI calls.
+
+Every model call goes through ``call_model``: it waits for a slot in the model's sliding
+one-minute quota (``MODEL_QUOTAS_RPM``, per worker process), lower ``PRIORITY_*`` values
+first, retries with backoff when Vertex AI still answers 429, and bills the result to the
+sessions that asked for it. Priorities only order calls to the same model; across models,
+synchronous bulk work holds a ``bulk_slot`` so it can never occupy every request thread.
+
+This module does not need GCP credentials or Flask, so it can be imported and tested on its
+own; the app installs ``session_resolver`` to bill the current browser session.
+"""
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Optional
+from cachetools import TTLCache
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Per-minute quotas (per worker process) and list prices
+MODEL_QUOTAS_RPM = {
+    "imagen-4.0-generate-001": int(os.getenv("IMAGEN_RPM", "20")),
+    "gemini-2.5-flash-image": int(os.getenv("GEMINI_IMAGE_RPM", "60")),
+    "gemini-2.5-pro": int(os.getenv("GEMINI_PRO_RPM", "60")),
+}
+MODEL_IMAGE_COST_USD = {
+    "imagen-4.0-generate-001": float(os.getenv("IMAGEN_COST_PER_IMAGE", "0.04")),
+    "gemini-2.5-flash-image": float(os.getenv("GEMINI_IMAGE_COST_PER_IMAGE", "0.039")),
+}
+# (input, output) USD per million tokens; output includes thinking tokens
+MODEL_TOKEN_COST_USD = {
+    "gemini-2.5-pro": (
+        float(os.getenv("GEMINI_PRO_INPUT_COST_PER_MTOK", "1.25")),
+        float(os.getenv("GEMINI_PRO_OUTPUT_COST_PER_MTOK", "10")),
+    ),
+}
+# Total time a call may spend queuing and backing off; keep it well below the gunicorn --timeout
+MODEL_QUEUE_TIMEOUT = float(os.getenv("MODEL_QUEUE_TIMEOUT", "60"))
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "3"))
+MODEL_RETRY_BACKOFF = float(os.getenv("MODEL_RETRY_BACKOFF", "2"))
+
+# Request threads that synchronous bulk work may hold at once; keep it below the gunicorn
+# --threads so interactive requests always find a free thread
+MODEL_BULK_CONCURRENCY = int(os.getenv("MODEL_BULK_CONCURRENCY", "4"))
+
+# Length of the sliding quota window in seconds
+QUOTA_WINDOW = 60.0
+
+# Priority classes: lower values are dispatched first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_STANDARD = 1
+PRIORITY_BULK = 2
+
+# Returns the session to bill when a call does not name one; the app points it at the
+# current request's session
+session_resolver: Callable[[], Optional[str]] = lambda: None
+
+_quota_cond = threading.Condition()
+_quota_dispatched: dict[str, deque] = defaultdict(deque)
+_quota_waiting: dict[str, list] = defaultdict(list)
+_quota_backoff_until: dict[str, float] = defaultdict(float)
+_quota_seq = itertools.count()
+_session_usage = TTLCache(maxsize=10000, ttl=24 * 3600)
+_usage_lock = threading.Lock()
+_bulk_slots = threading.BoundedSemaphore(MODEL_BULK_CONCURRENCY)
+
+
+class QuotaTimeoutError(RuntimeError):
+    """Raised when a model call waits longer than ``MODEL_QUEUE_TIMEOUT`` for quota."""
+
+
+def _acquire_model_slot(model: str, priority: int, queue_timeout: float = MODEL_QUEUE_TIMEOUT) -> None:
+    """Block until ``model`` has quota left in the current minute and no higher-priority call is waiting.
+
+    Raises:
+        QuotaTimeoutError: If no slot frees up within ``queue_timeout`` seconds.
+    """
+    rpm = MODEL_QUOTAS_RPM.get(model)
+    if not rpm:
+        return
+
+    ticket = (priority, next(_quota_seq))
+    deadline = time.monotonic() + queue_timeout
+    with _quota_cond:
+        waiting = _quota_waiting[model]
+        dispatched = _quota_dispatched[model]
+        heapq.heappush(waiting, ticket)
+        try:
+            while True:
+                now = time.monotonic()
+                while dispatched and now - dispatched[0] >= QUOTA_WINDOW:
+                    dispatched.popleft()
+
+                wait = max(_quota_backoff_until[model] - now, 0.0)
+                if len(dispatched) >= rpm:
+                    wait = max(wait, dispatched[0] + QUOTA_WINDOW - now)
+
+                if waiting[0] == ticket and wait <= 0:
+                    heapq.heappop(waiting)
+                    dispatched.append(now)
+                    return
+
+                if now >= deadline:
+                    raise QuotaTimeoutError(
+                        f"{model} quota exhausted; no free slot within the queue timeout")
+
+                # Only the head of the queue waits on the clock; others wait to be notified
+                timeout = deadline - now
+                if waiting[0] == ticket:
+                    timeout = min(wait, timeout)
+                _quota_cond.wait(timeout)
+        except BaseException:
+            if ticket in waiting:
+                waiting.remove(ticket)
+                heapq.heapify(waiting)
+            raise
+        finally:
+            _quota_cond.notify_all()
+
+
+@contextmanager
+def bulk_slot():
+    """Hold one of the ``MODEL_BULK_CONCURRENCY`` request threads reserved for bulk work.
+
+    Fails immediately instead of queuing, since a queued request would already be
+    holding the thread it is meant to leave free.
+
+    Raises:
+        QuotaTimeoutError: If every bulk slot is in use.
+    """
+    if not _bulk_slots.acquire(blocking=False):
+        raise QuotaTimeoutError(
+            "Too many bulk requests in progress; retry later or pass a callback_url")
+    try:
+        yield
+    finally:
+        _bulk_slots.release()
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Return True if ``error`` is a 429 / RESOURCE_EXHAUSTED response from Vertex AI."""
+    return getattr(error, "code", None) == 429 or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def _estimate_cost(model: str, images: int, usage_metadata) -> tuple[int, int, float]:
+    """Price one call from its output images and token usage.
+
+    Returns:
+        tuple[int, int, float]: Input tokens, output tokens and estimated USD cost.
+    """
+    input_tokens = getattr(usage_metadata, "prompt_token_count", None) or 0
+    output_tokens = (getattr(usage_metadata, "candidates_token_count", None) or 0) + \
+        (getattr(usage_metadata, "thoughts_token_count", None) or 0)
+    input_price, output_price = MODEL_TOKEN_COST_USD.get(model, (0.0, 0.0))
+    cost = images * MODEL_IMAGE_COST_USD.get(model, 0.0) + \
+        (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+    return input_tokens, output_tokens, cost
+
+
+def _count_output_images(result) -> int:
+    """Count the images returned by an Imagen or Gemini response."""
+    if hasattr(result, "images"):
+        return len(result.images)
+
+    count = 0
+    for candidate in getattr(result, "candidates", None) or []:
+        content = getattr(candidate, "content", None)
+        for part in getattr(content, "parts", None) or []:
+            if getattr(part, "inline_data", None) is not None:
+                count += 1
+    return count
+
+
+def _record_usage(session_ids: list[str], model: str, result, latency: float) -> None:
+    """Add one model call to the cost accounting of every session that shared it.
+
+    Batched calls (e.g. prompt refinement) split their tokens and cost evenly
+    between the sessions whose prompts were in the batch.
+    """
+    if not session_ids:
+        return
+
+    images = _count_output_images(result)
+    input_tokens, output_tokens, cost = _estimate_cost(
+        model, images, getattr(result, "usage_metadata", None))
+    share = len(session_ids)
+
+    with _usage_lock:
+        for session_id in session_ids:
+            usage = _session_usage.get(session_id) or {}
+            stats = usage.setdefault(model, {
+                "calls": 0, "images": 0, "input_tokens": 0, "output_tokens": 0,
+                "cost_usd": 0.0, "latency_s": 0.0})
+            stats["calls"] += 1
+            stats["images"] += images // share
+            stats["input_tokens"] += input_tokens // share
+            stats["output_tokens"] += output_tokens // share
+            stats["cost_usd"] = round(stats["cost_usd"] + cost / share, 6)
+            stats["latency_s"] = round(stats["latency_s"] + latency, 3)
+            _session_usage[session_id] = usage
+
+
+def call_model(model_id: str, call, *args, priority: int = PRIORITY_STANDARD,
+               queue_timeout: float = MODEL_QUEUE_TIMEOUT, max_retries: int = MODEL_MAX_RETRIES,
+               session_ids: Optional[list] = None, **kwargs):
+    """Dispatch a model call through the quota scheduler.
+
+    The call waits for a slot in ``model_id``'s per-minute quota (higher-priority
+    calls to the same model first), is retried with backoff when Vertex AI still
+    answers 429, and is recorded against the calling sessions' cost accounting.
+    Queuing and backoff together never exceed ``queue_timeout``, so the request
+    finishes (or answers 429) before the gunicorn worker timeout.
+
+    Args:
+        model_id (str): Model ID used for quota tracking and pricing.
+        call (Callable): The SDK method to invoke.
+        *args: Positional arguments for ``call``.
+        priority (int): One of ``PRIORITY_INTERACTIVE``, ``PRIORITY_STANDARD`` or ``PRIORITY_BULK``.
+        queue_timeout (float): Total seconds to wait for quota across all attempts; ``0`` fails fast.
+        max_retries (int): Retries after a 429 from Vertex AI.
+        session_ids (list, optional): Sessions to bill; defaults to ``session_resolver()``.
+        **kwargs: Keyword arguments for ``call``.
+
+    Returns:
+        The SDK response.
+
+    Raises:
+        QuotaTimeoutError: If the call could not be dispatched in time.
+    """
+    if session_ids is None:
+        session_ids = [session_resolver()]
+    session_ids = [session_id for session_id in session_ids if session_id]
+
+    deadline = time.monotonic() + queue_timeout
+    for attempt in range(max_retries + 1):
+        _acquire_model_slot(model_id, priority, max(deadline - time.monotonic(), 0.0))
+        started = time.monotonic()
+        try:
+            result = call(*args, **kwargs)
+        except Exception as e:
+            if not is_quota_error(e) or attempt == max_retries:
+                raise
+            backoff = min(MODEL_RETRY_BACKOFF * 2 ** attempt, 60.0)
+            with _quota_cond:
+                _quota_backoff_until[model_id] = max(
+                    _quota_backoff_until[model_id], time.monotonic() + backoff)
+                _quota_cond.notify_all()
+            print(f"⏳ {model_id} returned 429, backing off {backoff:.0f}s (attempt {attempt + 1}/{max_retries})")
+            continue
+
+        _record_usage(session_ids, model_id, result, time.monotonic() - started)
+        return result
+
+
+def session_usage(session_id: str) -> dict:
+    """Return a copy of the per-model usage recorded for ``session_id``."""
+    with _usage_lock:
+        return {model: dict(stats) for model, stats in (_session_usage.get(session_id) or {}).items()}
+
+
+def quota_status() -> dict:
+    """Return the remaining per-minute quota and queue depth for each scheduled model."""
+    now = time.monotonic()
+    with _quota_cond:
+        return {
+            model: {
+                "rpm": rpm,
+                "remaining": max(rpm - sum(1 for t in _quota_dispatched[model] if now - t < QUOTA_WINDOW), 0),
+                "queued": len(_quota_waiting[model]),
+            }
+            for model, rpm in MODEL_QUOTAS_RPM.items()
+        }
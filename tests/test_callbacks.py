@@ -0,0 +1,165 @@
+"""Callback delivery tests against a local HTTP receiver."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import hmac
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from img_gen_ai import callbacks
+
+SECRET = "test-signing-secret"
+
+
+class Receiver(ThreadingHTTPServer):
+    """Records every POST and answers with the next queued status code (default 200) after ``delay`` seconds."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ReceiverHandler)
+        self.requests = []
+        self.statuses = []
+        self.delay = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/hook"
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((dict(self.headers), body))
+        time.sleep(self.server.delay)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def receiver():
+    server = Receiver()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(callbacks, "CALLBACK_QUEUE_PATH", str(tmp_path / "callbacks.sqlite3"))
+    monkeypatch.setattr(callbacks, "CALLBACK_SIGNING_SECRET", SECRET)
+    # Deliver synchronously from the test instead of the background thread
+    monkeypatch.setattr(callbacks, "ensure_callback_worker", lambda: None)
+    monkeypatch.setattr(callbacks, "_inflight_jobs", set())
+    return tmp_path / "callbacks.sqlite3"
+
+
+def rows(queue):
+    conn = sqlite3.connect(queue)
+    try:
+        return conn.execute("SELECT id, status, attempts FROM callbacks").fetchall()
+    finally:
+        conn.close()
+
+
+def test_delivers_signed_manifest(receiver, queue):
+    manifest = {"job_id": "job-1", "status": "succeeded", "image_urls": ["http://x/static/a.png"]}
+    callbacks.enqueue_callback(receiver.url, manifest)
+
+    assert callbacks.deliver_due_callbacks() == 1
+
+    headers, body = receiver.requests[0]
+    assert json.loads(body) == manifest
+    assert headers["X-ImgGen-Delivery"] == "job-1"
+    expected = hmac.new(SECRET.encode(), headers["X-ImgGen-Timestamp"].encode() + b"." + body,
+                        hashlib.sha256).hexdigest()
+    assert headers["X-ImgGen-Signature"] == f"sha256={expected}"
+    assert rows(queue) == []
+
+
+def test_server_error_is_rescheduled(receiver, queue):
+    receiver.statuses = [503]
+    callbacks.enqueue_callback(receiver.url, {"job_id": "job-2"})
+
+    assert callbacks.deliver_due_callbacks() == 1
+    assert rows(queue) == [("job-2", "pending", 1)]
+
+
+def test_permanent_client_error_is_not_retried(receiver, queue):
+    receiver.statuses = [410]
+    callbacks.enqueue_callback(receiver.url, {"job_id": "job-3"})
+
+    callbacks.deliver_due_callbacks()
+    assert rows(queue) == [("job-3", "failed", 1)]
+    assert len(receiver.requests) == 1
+
+
+def test_interrupted_job_is_reported_as_failed(receiver, queue, monkeypatch):
+    monkeypatch.setattr(callbacks, "CALLBACK_JOB_LEASE", 0)
+    callbacks.create_callback_job("job-4", receiver.url, {"job_id": "job-4", "kind": "generate"})
+    # Simulate the owning worker dying: nothing renews the lease any more
+    callbacks._inflight_jobs.clear()
+
+    assert callbacks.deliver_due_callbacks() == 1
+    manifest = json.loads(receiver.requests[0][1])
+    assert manifest["status"] == "failed"
+    assert manifest["image_urls"] == []
+    assert rows(queue) == []
+
+
+def test_running_job_is_not_delivered_early(receiver, queue):
+    callbacks.create_callback_job("job-5", receiver.url, {"job_id": "job-5"})
+
+    assert callbacks.deliver_due_callbacks() == 0
+    callbacks.finish_callback_job(receiver.url, {"job_id": "job-5", "status": "succeeded"})
+    assert callbacks.deliver_due_callbacks() == 1
+    assert json.loads(receiver.requests[0][1])["status"] == "succeeded"
+
+
+def test_finished_job_is_not_redelivered_after_interruption(receiver, queue, monkeypatch):
+    monkeypatch.setattr(callbacks, "CALLBACK_JOB_LEASE", 0)
+    callbacks.create_callback_job("job-6", receiver.url, {"job_id": "job-6"})
+    callbacks._inflight_jobs.clear()
+    assert callbacks.deliver_due_callbacks() == 1
+
+    assert callbacks.finish_callback_job(receiver.url, {"job_id": "job-6", "status": "succeeded"}) is None
+    assert callbacks.deliver_due_callbacks() == 0
+    assert len(receiver.requests) == 1
+    assert json.loads(receiver.requests[0][1])["status"] == "failed"
+
+
+def test_leases_are_renewed_during_slow_deliveries(receiver, queue, monkeypatch):
+    monkeypatch.setattr(callbacks, "CALLBACK_JOB_LEASE", 0.6)
+    receiver.delay = 0.4
+    callbacks.create_callback_job("job-7", receiver.url, {"job_id": "job-7"})
+    for n in range(3):
+        callbacks.enqueue_callback(receiver.url, {"job_id": f"slow-{n}"})
+
+    assert callbacks.deliver_due_callbacks() == 3
+
+    conn = sqlite3.connect(queue)
+    try:
+        status, lease_until = conn.execute(
+            "SELECT status, lease_until FROM callbacks WHERE id = 'job-7'").fetchone()
+    finally:
+        conn.close()
+    assert status == "queued"
+    assert lease_until > time.time()
+
+
+def test_signing_requires_secret(monkeypatch):
+    monkeypatch.setattr(callbacks, "CALLBACK_SIGNING_SECRET", "")
+    assert not callbacks.callbacks_enabled()
+    with pytest.raises(RuntimeError):
+        callbacks.sign_callback(b"{}", "0")
@@ -0,0 +1,111 @@
+"""Quota scheduler and cost accounting tests with fake model calls."""
+
+from types import SimpleNamespace
+import threading
+import time
+
+import pytest
+
+from img_gen_ai import scheduler
+
+MODEL = "test-model"
+
+
+class QuotaExceeded(Exception):
+    code = 429
+
+
+@pytest.fixture(autouse=True)
+def quotas(monkeypatch):
+    monkeypatch.setattr(scheduler, "MODEL_QUOTAS_RPM", {MODEL: 1})
+    monkeypatch.setattr(scheduler, "MODEL_TOKEN_COST_USD", {MODEL: (1.0, 10.0)})
+    monkeypatch.setattr(scheduler, "QUOTA_WINDOW", 0.3)
+    monkeypatch.setattr(scheduler, "_quota_dispatched", scheduler.defaultdict(scheduler.deque))
+    monkeypatch.setattr(scheduler, "_quota_waiting", scheduler.defaultdict(list))
+    monkeypatch.setattr(scheduler, "_quota_backoff_until", scheduler.defaultdict(float))
+    monkeypatch.setattr(scheduler, "_session_usage", {})
+
+
+def wait_for_queued(count):
+    deadline = time.monotonic() + 2
+    while len(scheduler._quota_waiting[MODEL]) < count:
+        assert time.monotonic() < deadline, "waiters never queued"
+        time.sleep(0.005)
+
+
+def test_higher_priority_waiter_goes_first():
+    order = []
+    scheduler.call_model(MODEL, lambda: None, session_ids=[])
+
+    def run(name, priority):
+        scheduler.call_model(MODEL, order.append, name, priority=priority, queue_timeout=2, session_ids=[])
+
+    bulk = threading.Thread(target=run, args=("bulk", scheduler.PRIORITY_BULK))
+    bulk.start()
+    wait_for_queued(1)
+    interactive = threading.Thread(target=run, args=("interactive", scheduler.PRIORITY_INTERACTIVE))
+    interactive.start()
+    wait_for_queued(2)
+    bulk.join()
+    interactive.join()
+
+    assert order == ["interactive", "bulk"]
+
+
+def test_queue_timeout_raises_when_no_slot_frees():
+    scheduler.call_model(MODEL, lambda: None, session_ids=[])
+
+    started = time.monotonic()
+    with pytest.raises(scheduler.QuotaTimeoutError):
+        scheduler.call_model(MODEL, lambda: None, queue_timeout=0.1, session_ids=[])
+    assert time.monotonic() - started < 0.25
+    assert scheduler._quota_waiting[MODEL] == []
+
+
+def test_429_backoff_stays_within_queue_timeout(monkeypatch):
+    monkeypatch.setattr(scheduler, "MODEL_QUOTAS_RPM", {MODEL: 100})
+    monkeypatch.setattr(scheduler, "MODEL_RETRY_BACKOFF", 10.0)
+    calls = []
+
+    def always_exhausted():
+        calls.append(time.monotonic())
+        raise QuotaExceeded("RESOURCE_EXHAUSTED")
+
+    started = time.monotonic()
+    with pytest.raises(scheduler.QuotaTimeoutError):
+        scheduler.call_model(MODEL, always_exhausted, queue_timeout=0.2, max_retries=3, session_ids=[])
+    assert time.monotonic() - started < 0.5
+    assert len(calls) == 1
+
+
+def test_batched_cost_is_split_between_sessions():
+    response = SimpleNamespace(usage_metadata=SimpleNamespace(
+        prompt_token_count=300, candidates_token_count=200, thoughts_token_count=100))
+
+    scheduler.call_model(MODEL, lambda: response, queue_timeout=0, session_ids=["a", "b", "c"])
+
+    for session_id in ("a", "b", "c"):
+        stats = scheduler.session_usage(session_id)[MODEL]
+        assert stats["calls"] == 1
+        assert stats["input_tokens"] == 100
+        assert stats["output_tokens"] == 100
+        assert stats["cost_usd"] == pytest.approx((300 * 1.0 + 300 * 10.0) / 1_000_000 / 3)
+
+
+def test_calls_are_billed_to_resolved_session(monkeypatch):
+    monkeypatch.setattr(scheduler, "session_resolver", lambda: "current")
+
+    scheduler.call_model(MODEL, lambda: SimpleNamespace(images=[1, 2]), queue_timeout=0)
+
+    assert scheduler.session_usage("current")[MODEL]["images"] == 2
+
+
+def test_bulk_slots_are_capped(monkeypatch):
+    monkeypatch.setattr(scheduler, "_bulk_slots", threading.BoundedSemaphore(1))
+
+    with scheduler.bulk_slot():
+        with pytest.raises(scheduler.QuotaTimeoutError):
+            with scheduler.bulk_slot():
+                pass
+    with scheduler.bulk_slot():
+        pass